@@ -62,11 +62,14 @@ def validate_state(config, catalog, state):
 
 def _main(config, properties, state, discover_mode=False):
     client = Client(**config)
-    if discover_mode:
-        discover(client)
-    elif properties:
-        state = validate_state(config, properties, state)
-        sync(client, properties, config, state)
+    try:
+        if discover_mode:
+            discover(client)
+        elif properties:
+            state = validate_state(config, properties, state)
+            sync(client, properties, config, state)
+    finally:
+        client.close()
 
 
 def main():
@@ -1,10 +1,18 @@
 import re
+import threading
 import time
 
 import backoff
 import pendulum
 import requests
 import singer
+from requests.adapters import HTTPAdapter
+
+try:
+    import h2  # pylint: disable=unused-import
+    import httpx
+except ImportError:
+    httpx = None
 
 
 # By default, jobs will run for 3 hours and be polled every 5 minutes.
@@ -31,8 +39,33 @@ RATE_LIMIT_CALLS = 100
 RATE_LIMIT_SECONDS = 20
 
 DEFAULT_USER_AGENT = "Singer.io/tap-marketo"
+
+# When range chunking is enabled, several byte ranges are requested
+# concurrently ahead of the one currently being consumed.
+MAX_IN_FLIGHT_CHUNKS = 4
+
+# Streams are synced one at a time by default. Syncing several at once
+# overlaps the time spent waiting on bulk export jobs, but queues several
+# exports at once on the subscription's shared bulk export queue, so it
+# has to be enabled with the max_parallel_streams config value.
+MAX_PARALLEL_STREAMS = 1
+
+# Bulk export files are read in 5MB pieces, whether streamed over one
+# connection or requested as byte ranges.
+DEFAULT_CHUNK_SIZE = 5 * 1024 * 1024
+
+# httpx times out after 5 seconds by default, far too short for a 5MB
+# chunk on a slow connection. Allow up to 5 minutes on each phase.
+HTTP2_TIMEOUT = 60 * 5
 DOMAIN_RE = r"([\d]{3}-[\w]{3}-[\d]{3})"
 
+# Transport errors that are retried with backoff. httpx errors are only
+# raised by export chunk downloads made over HTTP/2.
+if httpx is not None:
+    RETRYABLE_ERRORS = (requests.exceptions.RequestException, httpx.HTTPError)
+else:
+    RETRYABLE_ERRORS = (requests.exceptions.RequestException,)
+
 
 def extract_domain(url):
     result = re.search(DOMAIN_RE, url)
@@ -80,7 +113,9 @@ class Client:
                  max_daily_calls=MAX_DAILY_CALLS,
                  user_agent=DEFAULT_USER_AGENT,
                  job_timeout=JOB_TIMEOUT,
-                 poll_interval=POLL_INTERVAL, **kwargs):
+                 poll_interval=POLL_INTERVAL,
+                 use_range_chunking=False,
+                 max_parallel_streams=MAX_PARALLEL_STREAMS, **kwargs):
 
         self.domain = extract_domain(endpoint)
         self.client_id = client_id
@@ -89,14 +124,37 @@ class Client:
         self.user_agent = user_agent
         self.job_timeout = job_timeout
         self.poll_interval = poll_interval
+        # Range chunking avoids long-lived connections that Marketo may
+        # drop mid-download, at the cost of one request per chunk.
+        self.use_range_chunking = str(use_range_chunking).lower() == "true"
 
         self.token_expires = None
         self.access_token = None
         self.calls_today = 0
 
+        # Every stream synced in parallel can have MAX_IN_FLIGHT_CHUNKS
+        # range requests running, keep a pooled connection for each.
+        self.pool_size = MAX_IN_FLIGHT_CHUNKS * max(1, int(max_parallel_streams))
         self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_connections=self.pool_size,
+                                                    pool_maxsize=self.pool_size))
+        self._calls_lock = threading.Lock()
         self._use_corona = None
 
+        # When httpx and h2 are installed, range chunked exports are
+        # downloaded over HTTP/2 so concurrent requests share a connection.
+        if httpx is not None and self.use_range_chunking:
+            self._http2 = httpx.Client(http2=True,
+                                       limits=httpx.Limits(max_connections=self.pool_size),
+                                       timeout=HTTP2_TIMEOUT)
+        else:
+            self._http2 = None
+
+    def close(self):
+        self._session.close()
+        if self._http2 is not None:
+            self._http2.close()
+
     @property
     def use_corona(self):
         if getattr(self, "_use_corona", None) is None:
@@ -158,13 +216,29 @@ class Client:
         self.token_expires = resp_time.add(seconds=data["expires_in"] - 15)
         singer.log_info("Token valid until %s", self.token_expires)
 
+    def _http2_get(self, url, headers):
+        # Reads the whole response body, which is what chunk downloads
+        # need anyway.
+        return self._http2.get(url, headers=headers)
+
     @singer.utils.ratelimit(RATE_LIMIT_CALLS, RATE_LIMIT_SECONDS)
-    @singer.utils.backoff((requests.exceptions.RequestException), singer.utils.exception_is_4xx)
-    def _request(self, method, url, endpoint_name=None, stream=False, **kwargs):
+    @singer.utils.backoff(RETRYABLE_ERRORS, singer.utils.exception_is_4xx)
+    def _request(self, method, url, endpoint_name=None, stream=False, http2=False, **kwargs):
         endpoint_name = endpoint_name or url
         url = self.get_url(url)
         headers = kwargs.pop("headers", {})
         headers.update(self.headers)
+        if http2 and method == "GET" and self._http2 is not None:
+            if kwargs:
+                raise TypeError("Unsupported arguments for an HTTP/2 request: {}".format(", ".join(sorted(kwargs))))
+
+            singer.log_info("%s: %s", method, url)
+            with singer.metrics.http_request_timer(endpoint_name):
+                resp = self._http2_get(url, headers)
+
+            resp.raise_for_status()
+            return resp
+
         req = requests.Request(method, url, headers=headers, **kwargs).prepare()
         singer.log_info("%s: %s", method, req.url)
         with singer.metrics.http_request_timer(endpoint_name):
@@ -185,16 +259,21 @@ class Client:
         singer.log_info("Used %s of %s requests", self.calls_today, self.max_daily_calls)
 
     @handle_short_term_rate_limit()
-    def request(self, method, url, endpoint_name=None, **kwargs):
-        if self.calls_today % 250 == 0:
-            self.update_calls_today()
-
-        self.calls_today += 1
-        if self.calls_today > self.max_daily_calls:
-            raise ApiException("Exceeded daily quota of {} calls".format(self.max_daily_calls))
+    def request(self, method, url, endpoint_name=None, raw=False, **kwargs):
+        # Export chunks are downloaded from several threads at once, so
+        # the quota bookkeeping must not interleave. Raw requests return
+        # the response without parsing it as JSON, like streamed ones, but
+        # their body is read inside _request where failed reads are retried.
+        with self._calls_lock:
+            if self.calls_today % 250 == 0:
+                self.update_calls_today()
+
+            self.calls_today += 1
+            if self.calls_today > self.max_daily_calls:
+                raise ApiException("Exceeded daily quota of {} calls".format(self.max_daily_calls))
 
         resp = self._request(method, url, endpoint_name, **kwargs)
-        if "stream" not in kwargs:
+        if "stream" not in kwargs and not raw:
             if resp.content == b'':
                 return {}
 
@@ -279,20 +358,22 @@ class Client:
 
     def poll_export(self, stream_type, export_id):
         # http://developers.marketo.com/rest-api/bulk-extract/#polling_job_status
-        return self.get_export_status(stream_type, export_id)["result"][0]["status"]
+        return self.get_export_status(stream_type, export_id)["result"][0]
 
     def stream_export(self, stream_type, export_id):
         # http://developers.marketo.com/rest-api/bulk-extract/#retrieving_your_data
         endpoint = self.get_bulk_endpoint(stream_type, "file", export_id)
         endpoint_name = "{}_stream".format(stream_type)
-        return self.request("GET", endpoint, endpoint_name=endpoint_name, stream=True)
+        resp = self.request("GET", endpoint, endpoint_name=endpoint_name, stream=True)
+        return resp.iter_content(chunk_size=DEFAULT_CHUNK_SIZE)
 
     def wait_for_export(self, stream_type, export_id):
         # Poll the export status until it enters a finalized state or
         # exceeds the job timeout time.
         timeout_time = pendulum.utcnow().add(seconds=self.job_timeout)
         while pendulum.utcnow() < timeout_time:
-            status = self.poll_export(stream_type, export_id)
+            export = self.poll_export(stream_type, export_id)
+            status = export["status"]
             singer.log_info("export %s status is %s", export_id, status)
 
             if status == "Created":
@@ -305,7 +386,9 @@ class Client:
                 raise ExportFailed(status)
 
             elif status == "Completed":
-                return True
+                # The final status includes the export's fileSize, which
+                # saves a request when downloading it in byte ranges.
+                return export
 
             time.sleep(self.poll_interval)
 
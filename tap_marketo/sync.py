@@ -1,13 +1,85 @@
+import codecs
+import collections
+import copy
 import csv
+import datetime
+import io
+import itertools
 import json
+import math
 import pendulum
-import tempfile
+import queue
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import singer
 from singer import metadata
 from singer import bookmarks
 from singer import utils
-from tap_marketo.client import ExportFailed, ApiQuotaExceeded
+from tap_marketo.client import (
+    ApiException,
+    ApiQuotaExceeded,
+    ExportFailed,
+    DEFAULT_CHUNK_SIZE,
+    MAX_IN_FLIGHT_CHUNKS,
+    MAX_PARALLEL_STREAMS,
+)
+
+# orjson rounds integers wider than 64 bits to floats, so anything with
+# that many digits in a row is left to json.
+_LONG_INTEGER_RE = re.compile(r"\d{19}")
+
+# orjson is an optional, much faster JSON library used for the activity
+# attributes and emitted records. Fall back to the standard library when
+# it isn't installed.
+try:
+    import orjson
+
+    def _json_loads(data):
+        # orjson also rejects NaN and lone surrogates, which json accepts.
+        if _LONG_INTEGER_RE.search(data):
+            return json.loads(data)
+        try:
+            return orjson.loads(data)  # pylint: disable=no-member
+        except orjson.JSONDecodeError:  # pylint: disable=no-member
+            return json.loads(data)
+
+    def _has_non_finite(value):
+        if isinstance(value, float):
+            return not math.isfinite(value)
+        if isinstance(value, dict):
+            return any(_has_non_finite(item) for item in value.values())
+        if isinstance(value, list):
+            return any(_has_non_finite(item) for item in value)
+        return False
+
+    def _json_dumps(obj):
+        # orjson can't encode integers wider than 64 bits or lone
+        # surrogates, and writes NaN and infinity as null. json writes all
+        # of them the way singer always has. Only output with a null can
+        # have lost a NaN, so the search is skipped otherwise.
+        try:
+            data = orjson.dumps(obj)  # pylint: disable=no-member
+        except orjson.JSONEncodeError:  # pylint: disable=no-member
+            return json.dumps(obj).encode("utf-8")
+        if b"null" in data and _has_non_finite(obj):
+            return json.dumps(obj).encode("utf-8")
+        return data
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+# When pyarrow is installed, exports are parsed by its multithreaded CSV
+# reader instead of the csv module.
+try:
+    import pyarrow
+    from pyarrow import csv as pyarrow_csv
+except ImportError:
+    pyarrow = None
 
 # We can request up to 30 days worth of activities per export.
 MAX_EXPORT_DAYS = 30
@@ -52,51 +124,224 @@ ITER_CHUNK_SIZE = 512
 
 ATTRIBUTION_WINDOW_DAYS = 1
 
+# Export rows are handed from the parsing thread to the formatting loop
+# in batches, with a bounded number of batches queued.
+ROW_BATCH_SIZE = 1000
+ROW_QUEUE_SIZE = 16
+
+# Records are buffered and written to stdout in blocks of about 1MB.
+RECORD_BUFFER_SIZE = 1024 * 1024
+
+# Activity attribute names normalized to interned column names. Each
+# activity type has a small, fixed set of attributes, so this stays tiny.
+_ATTRIBUTE_KEYS = {}
+
+
+class BufferedSingerWriter:
+    """
+    Writes RECORD messages to stdout in large blocks instead of one
+    write and flush per record. The buffer is flushed before any STATE
+    message so state never gets ahead of the records it covers.
+
+    Records are encoded as UTF-8 JSON and written to the binary stdout,
+    so the output doesn't depend on the console's encoding.
+
+    Streams synced in parallel share one writer. While `state` is set,
+    each stream passes only its own slice of the state, which is merged
+    into `state` before the full state is written. Once the sync fails
+    the writer is closed, and streams still running can't write anything
+    after the error. Each sync opens the writer again, and threads bound
+    to an earlier sync stay unable to write.
+    """
+
+    def __init__(self, buffer_size=RECORD_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self.state = None
+        self.closed = False
+        self.generation = 0
+        self.lock = threading.RLock()
+        self._local = threading.local()
+        self._lines = []
+        self._size = 0
+
+    def open(self, state=None):
+        with self.lock:
+            self.generation += 1
+            self.closed = False
+            self.state = state
+            return self.generation
+
+    def bind(self, generation):
+        # Ties the calling thread's writes to the sync that started it.
+        self._local.generation = generation
+
+    def _check_open(self):
+        if self.closed or getattr(self._local, "generation", self.generation) != self.generation:
+            raise RuntimeError("The sync has failed, no more messages can be written.")
+
+    def write_schema(self, stream_name, schema, key_properties, bookmark_properties=None):
+        with self.lock:
+            self._check_open()
+            singer.write_schema(stream_name, schema, key_properties, bookmark_properties=bookmark_properties)
+
+    def write_record(self, stream_name, record, time_extracted=None):
+        message = singer.RecordMessage(stream=stream_name, record=record, time_extracted=time_extracted)
+        line = _json_dumps(message.asdict())
+        with self.lock:
+            self._check_open()
+            self._lines.append(line)
+            self._size += len(line) + 1
+            if self._size >= self.buffer_size:
+                self.flush()
+
+    def write_state(self, state):
+        with self.lock:
+            self._check_open()
+            if self.state is not None and state is not self.state:
+                self.state.setdefault("bookmarks", {}).update(copy.deepcopy(state.get("bookmarks", {})))
+                state = self.state
+            self.flush()
+            singer.write_state(state)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self._lines = []
+            self._size = 0
+
+    def flush(self):
+        with self.lock:
+            if self._lines:
+                self._lines.append(b"")
+                data = b"\n".join(self._lines)
+                if hasattr(sys.stdout, "buffer"):
+                    # Anything already written as text must go out first.
+                    sys.stdout.flush()
+                    sys.stdout.buffer.write(data)
+                    sys.stdout.buffer.flush()
+                else:
+                    sys.stdout.write(data.decode("utf-8"))
+                    sys.stdout.flush()
+                self._lines = []
+                self._size = 0
+
+
+WRITER = BufferedSingerWriter()
+
+
+# datetime.fromisoformat was added in Python 3.7. Older interpreters
+# parse every date-time through pendulum.
+_fromisoformat = getattr(datetime.datetime, "fromisoformat", None)
+
+
+def _format_datetime(value):
+    # Marketo emits ISO 8601 timestamps, which datetime parses far faster
+    # than pendulum. Anything it rejects still goes through pendulum.
+    if _fromisoformat is None:
+        return pendulum.parse(value).isoformat()
 
-def format_value(value, schema):
+    try:
+        parsed = _fromisoformat(value[:-1] + "+00:00" if value.endswith("Z") else value)
+    except ValueError:
+        return pendulum.parse(value).isoformat()
+
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.isoformat()
+
+
+def _format_integer(value):
+    if isinstance(value, int):
+        return value
+
+    # Custom Marketo percent type fields can have decimals, so we drop them
+    decimal_index = value.find('.')
+    if decimal_index > 0:
+        singer.log_warning("Dropping decimal from integer type. Original Value: %s", value)
+        value = value[:decimal_index]
+    return int(value)
+
+
+def _format_boolean(value):
+    if isinstance(value, bool):
+        return value
+    return value.lower() == "true"
+
+
+def _coerce_string(value):
+    # Export values are already strings and pass straight through, only
+    # values parsed from JSON responses may still need converting.
+    if value in (None, "", 'null'):
+        return None
+    return value if type(value) is str else str(value)
+
+
+def _coerce_any(value):
+    if value in (None, "", 'null'):
+        return None
+    return value
+
+
+def _coercer(schema):
+    # Resolve the schema's type dispatch once, returning a function that
+    # only has to handle nulls and the one conversion the field needs.
     if not isinstance(schema["type"], list):
         field_type = [schema["type"]]
     else:
         field_type = schema["type"]
 
-    if value in [None, "", 'null']:
-        return None
-    elif schema.get("format") == "date-time":
-        return pendulum.parse(value).isoformat()
+    if schema.get("format") == "date-time":
+        convert = _format_datetime
     elif "integer" in field_type:
-        if isinstance(value, int):
-            return value
-
-        # Custom Marketo percent type fields can have decimals, so we drop them
-        decimal_index = value.find('.')
-        if decimal_index > 0:
-            singer.log_warning("Dropping decimal from integer type. Original Value: %s", value)
-            value = value[:decimal_index]
-        return int(value)
+        convert = _format_integer
     elif "string" in field_type:
-        return str(value)
+        return _coerce_string
     elif "number" in field_type:
-        return float(value)
+        convert = float
     elif "boolean" in field_type:
-        if isinstance(value, bool):
-            return value
-        return value.lower() == "true"
+        convert = _format_boolean
+    else:
+        return _coerce_any
 
-    return value
+    def coerce(value):
+        if value in (None, "", 'null'):
+            return None
+        return convert(value)
 
+    return coerce
 
-def format_values(stream, row):
-    rtn = {}
 
+def format_value(value, schema):
+    return _coercer(schema)(value)
+
+
+def get_available_fields(stream):
     available_fields = []
     for entry in stream['metadata']:
         if len(entry['breadcrumb']) > 0 and (entry['metadata'].get('selected') or entry['metadata'].get('inclusion') == 'automatic'):
             available_fields.append(entry['breadcrumb'][-1])
+    return available_fields
 
-    for field, schema in stream["schema"]["properties"].items():
-        if field in available_fields:
-            rtn[field] = format_value(row.get(field), schema)
-    return rtn
+
+def build_coercers(stream):
+    # Field selection and types don't change during a sync, so each sync
+    # function builds the (field, coercer) table once up front and keeps
+    # it on the stream for the row loops.
+    available_fields = get_available_fields(stream)
+    stream["_coercers"] = [(field, _coercer(schema))
+                           for field, schema in stream["schema"]["properties"].items()
+                           if field in available_fields]
+    return stream["_coercers"]
+
+
+def get_coercers(stream):
+    if "_coercers" not in stream:
+        return build_coercers(stream)
+    return stream["_coercers"]
+
+
+def format_values(stream, row):
+    return {field: coerce(row.get(field)) for field, coerce in get_coercers(stream)}
 
 
 def update_state_with_export_info(state, stream, bookmark=None, export_id=None, export_end=None):
@@ -105,7 +350,7 @@ def update_state_with_export_info(state, stream, bookmark=None, export_id=None,
     if bookmark:
         state = bookmarks.write_bookmark(state, stream["tap_stream_id"], determine_replication_key(stream['tap_stream_id']), bookmark)
 
-    singer.write_state(state)
+    WRITER.write_state(state)
     return state
 
 
@@ -120,30 +365,248 @@ def get_export_end(export_start, end_days=MAX_EXPORT_DAYS):
 def wait_for_export(client, state, stream, export_id):
     stream_type = "activities" if stream["tap_stream_id"] != "leads" else "leads"
     try:
-        client.wait_for_export(stream_type, export_id)
+        export = client.wait_for_export(stream_type, export_id)
     except ExportFailed:
         state = update_state_with_export_info(state, stream)
         raise
 
-    return state
+    return state, export.get("fileSize")
+
 
+def get_export_size(client, stream_type, export_id):
+    return client.get_export_status(stream_type, export_id)["result"][0]["fileSize"]
 
-# This function has an issue with UTF-8 data most likely caused by decode_unicode=True
-# See https://github.com/singer-io/tap-marketo/pull/51/files
-def stream_rows(client, stream_type, export_id):
-    with tempfile.NamedTemporaryFile(mode="w+", encoding="utf8") as csv_file:
-        singer.log_info("Download starting.")
-        resp = client.stream_export(stream_type, export_id)
-        for chunk in resp.iter_content(chunk_size=1024, decode_unicode=True):
-            if chunk:
-                csv_file.write(chunk)
 
-        singer.log_info("Download completed. Begin streaming rows.")
-        csv_file.seek(0)
-        reader = csv.reader(csv_file, delimiter=',', quotechar='"')
-        headers = next(reader)
-        for line in reader:
-            yield dict(zip(headers, line))
+def download_chunk(client, stream_type, export_id, start_byte, chunk_size):
+    # http://developers.marketo.com/rest-api/bulk-extract/#retrieving_your_data
+    endpoint = client.get_bulk_endpoint(stream_type, "file", export_id)
+    endpoint_name = "{}_stream".format(stream_type)
+    headers = {"Range": "bytes={}-{}".format(start_byte, start_byte + chunk_size - 1)}
+    resp = client.request("GET", endpoint, endpoint_name=endpoint_name, raw=True,
+                          headers=headers, http2=True)
+
+    # A server that ignores the Range header returns the whole file. That
+    # is only the requested chunk when the file fits in the first range,
+    # otherwise every chunk would repeat the same rows.
+    if resp.status_code != 206 and not (start_byte == 0 and len(resp.content) <= chunk_size):
+        raise ApiException("Expected bytes {}-{} of export {}, got status {}".format(
+            start_byte, start_byte + chunk_size - 1, export_id, resp.status_code))
+    return resp.content
+
+
+def gen_range_chunks(client, stream_type, export_id, export_size=None):
+    # Keep up to MAX_IN_FLIGHT_CHUNKS range requests running while the
+    # caller consumes the chunks. Futures are queued in offset order so
+    # chunks are always yielded in file order. The size normally comes
+    # from the final status poll, it is only requested when missing.
+    if export_size is None:
+        export_size = get_export_size(client, stream_type, export_id)
+    in_flight = collections.deque()
+    with ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT_CHUNKS) as executor:
+        try:
+            for start_byte in range(0, export_size, DEFAULT_CHUNK_SIZE):
+                in_flight.append(executor.submit(
+                    download_chunk, client, stream_type, export_id, start_byte, DEFAULT_CHUNK_SIZE))
+                if len(in_flight) >= MAX_IN_FLIGHT_CHUNKS:
+                    yield in_flight.popleft().result()
+
+            while in_flight:
+                yield in_flight.popleft().result()
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+
+def gen_export_chunks(client, stream_type, export_id, export_size=None):
+    if client.use_range_chunking:
+        return gen_range_chunks(client, stream_type, export_id, export_size)
+    return client.stream_export(stream_type, export_id)
+
+
+def _parse_csv_segment(text):
+    # Most export chunks contain no quoted values at all. Those can be
+    # split directly, which is several times faster than csv.reader.
+    # Anything with quotes or carriage returns goes through csv.reader.
+    # Blank lines hold no record and are skipped either way.
+    if '"' not in text and "\r" not in text:
+        return [line.split(",") for line in text.split("\n") if line]
+    return (row for row in csv.reader(io.StringIO(text, newline=""), delimiter=',', quotechar='"') if row)
+
+
+def _find_row_end(text, pos, in_quotes):
+    # Scans text from pos for the end of the last complete row, following
+    # csv.reader's quoting: a quote only opens a quoted value at the start
+    # of a field, and a doubled quote inside one is an escaped quote.
+    # Returns the end of the last row found (0 if none), the position to
+    # resume scanning from and whether that position is inside quotes.
+    row_end = 0
+    while True:
+        quote = text.find('"', pos)
+        if not in_quotes:
+            newline = text.rfind("\n", pos, len(text) if quote == -1 else quote)
+            if newline != -1:
+                row_end = newline + 1
+            if quote == -1:
+                return row_end, len(text), False
+            in_quotes = quote == 0 or text[quote - 1] in ",\r\n"
+            pos = quote + 1
+        elif quote == -1:
+            return row_end, len(text), True
+        elif quote + 1 == len(text):
+            # The next chunk decides whether this quote is escaped.
+            return row_end, quote, True
+        elif text[quote + 1] == '"':
+            pos = quote + 2
+        else:
+            in_quotes = False
+            pos = quote + 1
+
+
+def gen_csv_rows(chunks):
+    # A chunk boundary can fall in the middle of a multi-byte UTF-8
+    # character, the incremental decoder buffers those bytes until the
+    # next chunk completes the character.
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="strict")
+    text = ""
+    pos = 0
+    in_quotes = False
+    for byte_chunk in chunks:
+        text += decoder.decode(byte_chunk, final=False)
+
+        # Parse up to the last newline that ends a row and carry the rest
+        # into the next chunk. Quoted values can contain newlines, so the
+        # quoting state is carried along with the text, and only newly
+        # decoded text is scanned.
+        row_end, pos, in_quotes = _find_row_end(text, pos, in_quotes)
+        if row_end:
+            yield from _parse_csv_segment(text[:row_end])
+            text = text[row_end:]
+            pos -= row_end
+
+    text += decoder.decode(b"", final=True)
+    if text:
+        yield from _parse_csv_segment(text)
+
+
+class ChunkReader(io.RawIOBase):
+    """Exposes an iterator of byte chunks as a readable binary file."""
+
+    def __init__(self, chunks):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._chunk:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._chunk = memoryview(chunk)
+
+        size = min(len(b), len(self._chunk))
+        b[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+
+def _gen_batch_rows(batches, ragged_rows):
+    # Rows with the wrong number of columns are left out of the batches
+    # and parsed separately, keyed by their row number. Put each one back
+    # in its place. A row is always reported before the batch holding
+    # the rows after it.
+    number = 0
+    for batch in batches:
+        for row in zip(*(column.to_pylist() for column in batch.columns)):
+            number += 1
+            while number in ragged_rows:
+                yield ragged_rows.pop(number)
+                number += 1
+            yield row
+
+    for number in sorted(ragged_rows):
+        yield ragged_rows.pop(number)
+
+
+def read_export_batches(client, stream_type, export_id, export_size=None):
+    chunks = gen_export_chunks(client, stream_type, export_id, export_size)
+    export_file = io.BufferedReader(ChunkReader(chunks))
+
+    # Read the header ourselves so every column can be declared a string,
+    # leaving value conversion to the stream's coercers.
+    header_line = export_file.readline().decode("utf-8")
+    headers = next(csv.reader([header_line]), [])
+    if not headers or not export_file.peek(1):
+        return headers, iter(())
+
+    # pyarrow can't return rows that don't match the header, the csv
+    # module returns them as they are. Parse those with csv to match.
+    ragged_rows = {}
+
+    def handle_ragged_row(row):
+        ragged_rows[row.number] = next(csv.reader(io.StringIO(row.text, newline="")), [])
+        return "skip"
+
+    batches = pyarrow_csv.open_csv(
+        export_file,
+        read_options=pyarrow_csv.ReadOptions(column_names=headers, block_size=DEFAULT_CHUNK_SIZE),
+        parse_options=pyarrow_csv.ParseOptions(newlines_in_values=True, invalid_row_handler=handle_ragged_row),
+        convert_options=pyarrow_csv.ConvertOptions(column_types={h: pyarrow.string() for h in headers}))
+    return headers, _gen_batch_rows(batches, ragged_rows)
+
+
+def gen_prefetched_rows(rows):
+    # Download and parse rows on a background thread, handing them over
+    # in batches, so the caller's formatting and writing overlaps with
+    # the network and parsing work instead of alternating with it.
+    row_queue = queue.Queue(maxsize=ROW_QUEUE_SIZE)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                row_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            while True:
+                batch = list(itertools.islice(rows, ROW_BATCH_SIZE))
+                if not batch or not put(batch):
+                    break
+            put(None)
+        except Exception as ex:  # pylint: disable=broad-except
+            put(ex)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            batch = row_queue.get()
+            if batch is None:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield from batch
+    finally:
+        # Let the producer exit if the caller stops early.
+        stopped.set()
+
+
+def read_export(client, stream_type, export_id, export_size=None):
+    # Rows are parsed as the export downloads, chunk by chunk. Returns the
+    # header and an iterator over the remaining rows as sequences.
+    if pyarrow is not None:
+        headers, rows = read_export_batches(client, stream_type, export_id, export_size)
+    else:
+        rows = gen_csv_rows(gen_export_chunks(client, stream_type, export_id, export_size))
+        headers = next(rows, [])
+
+    return headers, gen_prefetched_rows(rows)
 
 
 def get_or_create_export_for_leads(client, state, stream, export_start):
@@ -163,11 +626,7 @@ def get_or_create_export_for_leads(client, state, stream, export_start):
 
         # Create the new export and store the id and end date in state.
         # Does not start the export (must POST to the "enqueue" endpoint).
-        fields = []
-        for entry in stream['metadata']:
-            if len(entry['breadcrumb']) > 0 and (entry['metadata'].get('selected') or entry['metadata'].get('inclusion') == 'automatic'):
-                fields.append(entry['breadcrumb'][-1])
-
+        fields = get_available_fields(stream)
         export_id = client.create_export("leads", fields, query)
         state = update_state_with_export_info(
             state, stream, export_id=export_id, export_end=export_end.isoformat())
@@ -224,35 +683,82 @@ def get_or_create_export_for_activities(client, state, stream, export_start, con
     return export_id, export_end
 
 
-def flatten_activity(row, stream):
-    # Start with the base fields
-    rtn = {field: row[field] for field in BASE_ACTIVITY_FIELDS}
-
-    # Add the primary attribute name
+def get_primary_attribute_name(stream):
     # This name is the human readable name/description of the
     # pimaryAttribute
     mdata = metadata.to_map(stream['metadata'])
-    pan_field = metadata.get(mdata, (), 'marketo.primary-attribute-name')
-    if pan_field:
-        rtn['primary_attribute_name'] = pan_field
-        rtn['primary_attribute_value'] = row['primaryAttributeValue']
-        rtn['primary_attribute_value_id'] = row['primaryAttributeValueId']
-
-    # Now flatten the attrs json to it's selected columns
-    if "attributes" in row:
-        attrs = json.loads(row["attributes"])
-        for key, value in attrs.items():
-            key = key.lower().replace(" ", "_")
-            rtn[key] = value
+    return metadata.get(mdata, (), 'marketo.primary-attribute-name')
+
 
+def flatten_attributes(attributes):
+    rtn = {}
+    for key, value in _json_loads(attributes).items():
+        column = _ATTRIBUTE_KEYS.get(key)
+        if column is None:
+            column = _ATTRIBUTE_KEYS.setdefault(key, sys.intern(key.lower().replace(" ", "_")))
+        rtn[column] = value
     return rtn
 
 
+def compile_row_fn(stream, headers):
+    # Generate a function specialized to this export's header and the
+    # stream's selected fields, which turns a csv row list straight into
+    # a formatted record. Column positions, coercers and, for activities,
+    # the primary attribute name are resolved here instead of per row.
+    col_idx = {name: i for i, name in enumerate(headers)}
+    is_activity = stream["tap_stream_id"].startswith("activities_")
+    pan_field = get_primary_attribute_name(stream) if is_activity else None
+
+    namespace = {"flatten_attributes": flatten_attributes}
+    values = []
+    for i, (field, coerce) in enumerate(get_coercers(stream)):
+        if is_activity and field not in BASE_ACTIVITY_FIELDS:
+            if field == "primary_attribute_name":
+                source = repr(pan_field) if pan_field else None
+            elif field == "primary_attribute_value":
+                source = "row[{}]".format(col_idx["primaryAttributeValue"]) if pan_field else None
+            elif field == "primary_attribute_value_id":
+                source = "row[{}]".format(col_idx["primaryAttributeValueId"]) if pan_field else None
+            else:
+                source = "attrs.get({!r})".format(field)
+        elif field in col_idx:
+            source = "row[{}]".format(col_idx[field])
+        else:
+            source = None
+
+        if source is None:
+            # Fields missing from the export are always null.
+            values.append("        {!r}: None,".format(field))
+        else:
+            namespace["_c{}".format(i)] = coerce
+            values.append("        {!r}: _c{}({}),".format(field, i, source))
+
+    # Rows shorter than the header are padded with nulls, as zipping them
+    # with the header used to leave the missing columns out.
+    lines = [
+        "def row_fn(row):",
+        "    if len(row) < {}:".format(len(headers)),
+        "        row = list(row) + [None] * ({} - len(row))".format(len(headers)),
+    ]
+    if is_activity:
+        if "attributes" in col_idx:
+            lines.append("    attrs = flatten_attributes(row[{0}]) if row[{0}] else {{}}".format(col_idx["attributes"]))
+        else:
+            lines.append("    attrs = {}")
+    lines.append("    return {")
+    lines.extend(values)
+    lines.append("    }")
+
+    exec("\n".join(lines), namespace)  # pylint: disable=exec-used
+    return namespace["row_fn"]
+
+
 def sync_leads(client, state, stream):
     # http://developers.marketo.com/rest-api/bulk-extract/bulk-lead-extract/
     replication_key = determine_replication_key(stream["tap_stream_id"])
 
-    singer.write_schema("leads", stream["schema"], stream["key_properties"], bookmark_properties=[replication_key])
+    WRITER.write_schema("leads", stream["schema"], stream["key_properties"], bookmark_properties=[replication_key])
+    build_coercers(stream)
     initial_bookmark = pendulum.parse(bookmarks.get_bookmark(state, "leads", replication_key))
     export_start = pendulum.parse(bookmarks.get_bookmark(state, "leads", replication_key))
     if client.use_corona:
@@ -260,29 +766,45 @@ def sync_leads(client, state, stream):
 
     job_started = pendulum.utcnow()
     record_count = 0
+
+    # Record timestamps are formatted as ISO 8601 and are almost always
+    # UTC, in which case they order correctly as plain strings. Compare
+    # them that way instead of parsing a datetime for every record.
+    initial_bookmark = initial_bookmark.in_timezone("UTC").isoformat()
     max_bookmark = initial_bookmark
     while export_start < job_started:
         export_id, export_end = get_or_create_export_for_leads(client, state, stream, export_start)
-        state = wait_for_export(client, state, stream, export_id)
-        for row in stream_rows(client, "leads", export_id):
+        state, export_size = wait_for_export(client, state, stream, export_id)
+        headers, rows = read_export(client, "leads", export_id, export_size)
+        row_fn = compile_row_fn(stream, headers)
+        for row in rows:
             time_extracted = utils.now()
 
-            record = format_values(stream, row)
-            record_bookmark = pendulum.parse(record[replication_key])
+            record = row_fn(row)
+            record_bookmark = record[replication_key]
 
             if client.use_corona:
-                max_bookmark = export_end
+                max_bookmark = export_end.isoformat()
 
-                singer.write_record("leads", record, time_extracted=time_extracted)
+                WRITER.write_record("leads", record, time_extracted=time_extracted)
                 record_count += 1
-            elif record_bookmark >= initial_bookmark:
-                max_bookmark = max(max_bookmark, record_bookmark)
-
-                singer.write_record("leads", record, time_extracted=time_extracted)
+            elif record_bookmark is None:
+                # Without a timestamp the record can't be filtered, so
+                # emit it rather than drop it.
+                WRITER.write_record("leads", record, time_extracted=time_extracted)
                 record_count += 1
+            else:
+                if not record_bookmark.endswith("+00:00"):
+                    record_bookmark = pendulum.parse(record_bookmark).in_timezone("UTC").isoformat()
+
+                if record_bookmark >= initial_bookmark:
+                    max_bookmark = max(max_bookmark, record_bookmark)
+
+                    WRITER.write_record("leads", record, time_extracted=time_extracted)
+                    record_count += 1
 
         # Now that one of the exports is finished, update the bookmark
-        state = update_state_with_export_info(state, stream, bookmark=max_bookmark.isoformat())
+        state = update_state_with_export_info(state, stream, bookmark=max_bookmark)
         export_start = export_end
 
     return state, record_count
@@ -291,20 +813,22 @@ def sync_leads(client, state, stream):
 def sync_activities(client, state, stream, config):
     # http://developers.marketo.com/rest-api/bulk-extract/bulk-activity-extract/
     replication_key = determine_replication_key(stream['tap_stream_id'])
-    singer.write_schema(stream["tap_stream_id"], stream["schema"], stream["key_properties"], bookmark_properties=[replication_key])
+    WRITER.write_schema(stream["tap_stream_id"], stream["schema"], stream["key_properties"], bookmark_properties=[replication_key])
+    build_coercers(stream)
     export_start = pendulum.parse(bookmarks.get_bookmark(state, stream["tap_stream_id"], replication_key))
     job_started = pendulum.utcnow()
     record_count = 0
     while export_start < job_started:
         export_id, export_end = get_or_create_export_for_activities(client, state, stream, export_start, config)
-        state = wait_for_export(client, state, stream, export_id)
-        for row in stream_rows(client, "activities", export_id):
+        state, export_size = wait_for_export(client, state, stream, export_id)
+        headers, rows = read_export(client, "activities", export_id, export_size)
+        row_fn = compile_row_fn(stream, headers)
+        for row in rows:
             time_extracted = utils.now()
 
-            row = flatten_activity(row, stream)
-            record = format_values(stream, row)
+            record = row_fn(row)
 
-            singer.write_record(stream["tap_stream_id"], record, time_extracted=time_extracted)
+            WRITER.write_record(stream["tap_stream_id"], record, time_extracted=time_extracted)
             record_count += 1
 
         state = update_state_with_export_info(state, stream, bookmark=export_start.isoformat())
@@ -325,7 +849,8 @@ def sync_programs(client, state, stream):
     # is returned to indicate that the endpoint has been fully synced.
     replication_key = determine_replication_key(stream['tap_stream_id'])
 
-    singer.write_schema("programs", stream["schema"], stream["key_properties"], bookmark_properties=[replication_key])
+    WRITER.write_schema("programs", stream["schema"], stream["key_properties"], bookmark_properties=[replication_key])
+    build_coercers(stream)
     start_date = bookmarks.get_bookmark(state, "programs", replication_key)
     end_date = pendulum.utcnow().isoformat()
     params = {
@@ -337,32 +862,37 @@ def sync_programs(client, state, stream):
     endpoint = "rest/asset/v1/programs.json"
 
     record_count = 0
-    while True:
+    with ThreadPoolExecutor(max_workers=1) as executor:
         data = client.request("GET", endpoint, endpoint_name="programs", params=params)
+        while True:
+            # If the no asset message is in the warnings, we have exhausted
+            # the search results and can end the sync.
+            if "warnings" in data and NO_ASSET_MSG in data["warnings"]:
+                break
+
+            # Increment the offset by the return limit and fetch the next
+            # page while this one is processed.
+            params["offset"] += params["maxReturn"]
+            next_page = executor.submit(client.request, "GET", endpoint,
+                                        endpoint_name="programs", params=dict(params))
 
-        # If the no asset message is in the warnings, we have exhausted
-        # the search results and can end the sync.
-        if "warnings" in data and NO_ASSET_MSG in data["warnings"]:
-            break
+            time_extracted = utils.now()
 
-        time_extracted = utils.now()
+            # Each row just needs the values formatted. If the record is
+            # newer than the original start date, stream the record.
+            for row in data["result"]:
+                record = format_values(stream, row)
+                if record[replication_key] >= start_date:
+                    record_count += 1
 
-        # Each row just needs the values formatted. If the record is
-        # newer than the original start date, stream the record.
-        for row in data["result"]:
-            record = format_values(stream, row)
-            if record[replication_key] >= start_date:
-                record_count += 1
+                    WRITER.write_record("programs", record, time_extracted=time_extracted)
 
-                singer.write_record("programs", record, time_extracted=time_extracted)
-
-        # Increment the offset by the return limit for the next query.
-        params["offset"] += params["maxReturn"]
+            data = next_page.result()
 
     # Now that we've finished every page we can update the bookmark to
     # the end of the query.
     state = bookmarks.write_bookmark(state, "programs", replication_key, end_date)
-    singer.write_state(state)
+    WRITER.write_state(state)
     return state, record_count
 
 
@@ -375,7 +905,8 @@ def sync_paginated(client, state, stream):
     # return updated records.
     replication_key = determine_replication_key(stream['tap_stream_id'])
 
-    singer.write_schema(stream["tap_stream_id"], stream["schema"], stream["key_properties"], bookmark_properties=[replication_key])
+    WRITER.write_schema(stream["tap_stream_id"], stream["schema"], stream["key_properties"], bookmark_properties=[replication_key])
+    build_coercers(stream)
     start_date = bookmarks.get_bookmark(state, stream["tap_stream_id"], replication_key)
     params = {"batchSize": 300}
     endpoint = "rest/v1/{}.json".format(stream["tap_stream_id"])
@@ -390,35 +921,42 @@ def sync_paginated(client, state, stream):
     # Keep querying pages of data until no next page token.
     record_count = 0
     job_started = pendulum.utcnow().isoformat()
-    while True:
+    with ThreadPoolExecutor(max_workers=1) as executor:
         data = client.request("GET", endpoint, endpoint_name=stream["tap_stream_id"], params=params)
+        while True:
+            # Fetch the next page while this one is processed.
+            next_page = None
+            if "nextPageToken" in data:
+                params["nextPageToken"] = data["nextPageToken"]
+                next_page = executor.submit(client.request, "GET", endpoint,
+                                            endpoint_name=stream["tap_stream_id"], params=dict(params))
 
-        time_extracted = utils.now()
+            time_extracted = utils.now()
 
-        # Each row just needs the values formatted. If the record is
-        # newer than the original start date, stream the record. Finally,
-        # update the bookmark if newer than the existing bookmark.
-        for row in data["result"]:
-            record = format_values(stream, row)
-            if record[replication_key] >= start_date:
-                record_count += 1
+            # Each row just needs the values formatted. If the record is
+            # newer than the original start date, stream the record. Finally,
+            # update the bookmark if newer than the existing bookmark.
+            for row in data["result"]:
+                record = format_values(stream, row)
+                if record[replication_key] >= start_date:
+                    record_count += 1
 
-                singer.write_record(stream["tap_stream_id"], record, time_extracted=time_extracted)
+                    WRITER.write_record(stream["tap_stream_id"], record, time_extracted=time_extracted)
 
-        # No next page, results are exhausted.
-        if "nextPageToken" not in data:
-            break
+            # No next page, results are exhausted.
+            if next_page is None:
+                break
 
-        # Store the next page token in state and continue.
-        params["nextPageToken"] = data["nextPageToken"]
-        state = bookmarks.write_bookmark(state, stream["tap_stream_id"], "next_page_token", data["nextPageToken"])
-        singer.write_state(state)
+            # Store the next page token in state and continue.
+            state = bookmarks.write_bookmark(state, stream["tap_stream_id"], "next_page_token", data["nextPageToken"])
+            WRITER.write_state(state)
+            data = next_page.result()
 
     # Once all results are exhausted, unset the next page token bookmark
     # so the subsequent sync starts from the beginning.
     state = bookmarks.write_bookmark(state, stream["tap_stream_id"], "next_page_token", None)
     state = bookmarks.write_bookmark(state, stream["tap_stream_id"], replication_key, job_started)
-    singer.write_state(state)
+    WRITER.write_state(state)
     return state, record_count
 
 
@@ -428,7 +966,8 @@ def sync_activity_types(client, state, stream):
     # Activity types aren't even paginated. Grab all the results in one
     # request, format the values, and output them.
 
-    singer.write_schema("activity_types", stream["schema"], stream["key_properties"])
+    WRITER.write_schema("activity_types", stream["schema"], stream["key_properties"])
+    build_coercers(stream)
     endpoint = "rest/v1/activities/types.json"
     data = client.request("GET", endpoint, endpoint_name="activity_types")
     record_count = 0
@@ -439,11 +978,37 @@ def sync_activity_types(client, state, stream):
         record = format_values(stream, row)
         record_count += 1
 
-        singer.write_record("activity_types", record, time_extracted=time_extracted)
+        WRITER.write_record("activity_types", record, time_extracted=time_extracted)
 
     return state, record_count
 
 
+def sync_stream(client, state, stream, config):
+    tap_stream_id = stream["tap_stream_id"]
+    singer.log_info("%s: starting sync", tap_stream_id)
+
+    # Sync stream based on type.
+    if tap_stream_id == "activity_types":
+        state, record_count = sync_activity_types(client, state, stream)
+    elif tap_stream_id == "leads":
+        state, record_count = sync_leads(client, state, stream)
+    elif tap_stream_id.startswith("activities_"):
+        state, record_count = sync_activities(client, state, stream, config)
+    elif tap_stream_id in ["campaigns", "lists"]:
+        state, record_count = sync_paginated(client, state, stream)
+    elif tap_stream_id == "programs":
+        state, record_count = sync_programs(client, state, stream)
+    else:
+        raise Exception("Stream %s not implemented" % tap_stream_id)
+
+    # Emit metric for record count.
+    counter = singer.metrics.record_counter(tap_stream_id)
+    counter.value = record_count
+    counter._pop()  # pylint: disable=protected-access
+
+    return state
+
+
 def sync(client, catalog, config, state):
     starting_stream = bookmarks.get_currently_syncing(state)
     if starting_stream:
@@ -451,6 +1016,7 @@ def sync(client, catalog, config, state):
     else:
         singer.log_info("Starting sync")
 
+    streams = []
     for stream in catalog["streams"]:
         # Skip unselected streams.
         mdata = metadata.to_map(stream['metadata'])
@@ -464,37 +1030,63 @@ def sync(client, catalog, config, state):
             singer.log_info("%s: already synced", stream["tap_stream_id"])
             continue
 
-        singer.log_info("%s: starting sync", stream["tap_stream_id"])
-
-        # Now that we've started, there's no more "starting stream". Set
-        # the current stream to resume on next run.
         starting_stream = None
-        state = bookmarks.set_currently_syncing(state, stream["tap_stream_id"])
-        singer.write_state(state)
-
-        # Sync stream based on type.
-        if stream["tap_stream_id"] == "activity_types":
-            state, record_count = sync_activity_types(client, state, stream)
-        elif stream["tap_stream_id"] == "leads":
-            state, record_count = sync_leads(client, state, stream)
-        elif stream["tap_stream_id"].startswith("activities_"):
-            state, record_count = sync_activities(client, state, stream, config)
-        elif stream["tap_stream_id"] in ["campaigns", "lists"]:
-            state, record_count = sync_paginated(client, state, stream)
-        elif stream["tap_stream_id"] == "programs":
-            state, record_count = sync_programs(client, state, stream)
-        else:
-            raise Exception("Stream %s not implemented" % stream["tap_stream_id"])
-
-        # Emit metric for record count.
-        counter = singer.metrics.record_counter(stream["tap_stream_id"])
-        counter.value = record_count
-        counter._pop()  # pylint: disable=protected-access
-
-        # Unset current stream.
-        state = bookmarks.set_currently_syncing(state, None)
-        singer.write_state(state)
-        singer.log_info("%s: finished sync", stream["tap_stream_id"])
+        streams.append(stream)
+
+    # Streams are independent, so several can be synced at once. Each one
+    # works on its own slice of the state, which the writer merges back
+    # into the full state whenever state is written. The current stream
+    # is always the first unfinished one, so resuming never skips a
+    # stream that didn't finish.
+    pending = [stream["tap_stream_id"] for stream in streams]
+    # At least one stream must be syncing or the sync never finishes.
+    max_parallel_streams = max(1, int(config.get('max_parallel_streams', MAX_PARALLEL_STREAMS)))
+    stream_queue = queue.Queue()
+    for stream in streams:
+        bookmark = state.get("bookmarks", {}).get(stream["tap_stream_id"], {})
+        stream_queue.put((stream, {"bookmarks": {stream["tap_stream_id"]: copy.deepcopy(bookmark)}}))
+
+    results = queue.Queue()
+    failed = threading.Event()
+
+    def sync_streams(generation):
+        WRITER.bind(generation)
+        while not failed.is_set():
+            try:
+                stream, stream_state = stream_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results.put((stream["tap_stream_id"], sync_stream(client, stream_state, stream, config), None))
+            except Exception as ex:  # pylint: disable=broad-except
+                results.put((stream["tap_stream_id"], None, ex))
+
+    generation = WRITER.open(state)
+    try:
+        with WRITER.lock:
+            state = bookmarks.set_currently_syncing(state, pending[0] if pending else None)
+            WRITER.write_state(state)
+
+        # Streams run on daemon threads so a failure can be raised right
+        # away. Waiting for the other streams could mean hours of export
+        # polling, instead they are abandoned with the writer closed.
+        for _ in range(min(max_parallel_streams, len(streams))):
+            threading.Thread(target=sync_streams, args=(generation,), daemon=True).start()
+
+        for _ in streams:
+            tap_stream_id, stream_state, ex = results.get()
+            if ex is not None:
+                failed.set()
+                WRITER.close()
+                raise ex
+
+            with WRITER.lock:
+                pending.remove(tap_stream_id)
+                state = bookmarks.set_currently_syncing(state, pending[0] if pending else None)
+                WRITER.write_state(stream_state)
+            singer.log_info("%s: finished sync", tap_stream_id)
+    finally:
+        WRITER.state = None
 
     # If Corona is not supported, log a warning near the end of the tap
     # log with instructions on how to get Corona supported.
@@ -17,6 +17,10 @@ class TestClient(unittest.TestCase):
     def setUp(self):
         self.client = Client("123-ABC-789", "id", "secret")
 
+    def test_pool_size(self):
+        self.assertEqual(MAX_IN_FLIGHT_CHUNKS, Client("123-ABC-789", "id", "secret", max_parallel_streams=0).pool_size)
+        self.assertEqual(2 * MAX_IN_FLIGHT_CHUNKS, Client("123-ABC-789", "id", "secret", max_parallel_streams="2").pool_size)
+
     def test_extract_domain(self):
         self.assertEqual("123-ABC-789", extract_domain("https://123-ABC-789.mktorest.com/rest"))
         with self.assertRaises(ValueError):
@@ -113,6 +117,42 @@ class TestClient(unittest.TestCase):
             mock.register_uri("POST", self.client.get_url(create), json={"errors": [{"code": "1035"}]})
             self.assertFalse(self.client.use_corona)
 
+    def test_http2_request_uses_http2_client(self):
+        # disable refresh_token being called
+        self.client.token_expires = pendulum.utcnow().add(days=1)
+        # disable calls_today
+        self.client.calls_today = 1
+        self.client._http2 = unittest.mock.MagicMock()
+        self.client._http2.get.return_value.status_code = 206
+        resp = self.client.request("GET", "file", stream=True, headers={"Range": "bytes=0-9"}, http2=True)
+
+        self.assertEqual(self.client._http2.get.return_value, resp)
+        headers = self.client._http2.get.call_args[1]["headers"]
+        self.assertEqual("bytes=0-9", headers["Range"])
+        self.assertEqual(2, self.client.calls_today)
+
+    def test_http2_request_rejects_unsupported_arguments(self):
+        # disable refresh_token being called
+        self.client.token_expires = pendulum.utcnow().add(days=1)
+        # disable calls_today
+        self.client.calls_today = 1
+        self.client._http2 = unittest.mock.MagicMock()
+        with self.assertRaises(TypeError):
+            self.client.request("GET", "file", stream=True, params={"a": 1}, http2=True)
+        self.client._http2.get.assert_not_called()
+
+    def test_http2_request_falls_back_to_session(self):
+        # disable refresh_token being called
+        self.client.token_expires = pendulum.utcnow().add(days=1)
+        # disable calls_today
+        self.client.calls_today = 1
+        self.client._http2 = None
+        with requests_mock.Mocker(real_http=True) as mock:
+            mock.register_uri("GET", self.client.get_url("file"), content=b"0123456789", status_code=206)
+            resp = self.client.request("GET", "file", stream=True, headers={"Range": "bytes=0-9"}, http2=True)
+
+        self.assertEqual(b"0123456789", resp.content)
+
 
 class TestExports(unittest.TestCase):
     def setUp(self):
@@ -123,10 +163,11 @@ class TestExports(unittest.TestCase):
     def test_export_enqueued(self):
         export_id = "123"
         self.client.poll_interval = 0
-        self.client.poll_export = unittest.mock.MagicMock(side_effect=["Created", "Completed"])
+        completed = {"status": "Completed", "fileSize": 10}
+        self.client.poll_export = unittest.mock.MagicMock(side_effect=[{"status": "Created"}, completed])
         self.client.enqueue_export = unittest.mock.MagicMock()
 
-        self.assertTrue(self.client.wait_for_export("test", export_id))
+        self.assertEqual(completed, self.client.wait_for_export("test", export_id))
         self.client.enqueue_export.assert_called_once_with("test", export_id)
 
     def test_api_exception(self):
@@ -141,7 +182,7 @@ class TestExports(unittest.TestCase):
         export_id = "123"
         self.client.poll_interval = 0
         self.client.job_timeout = 0
-        self.client.poll_export = unittest.mock.MagicMock(side_effect=itertools.repeat("Queued"))
+        self.client.poll_export = unittest.mock.MagicMock(side_effect=itertools.repeat({"status": "Queued"}))
 
         with self.assertRaises(ExportFailed):
             self.client.wait_for_export("test", export_id)
@@ -149,7 +190,7 @@ class TestExports(unittest.TestCase):
     def test_export_failed(self):
         export_id = "123"
         self.client.poll_interval = 0
-        self.client.poll_export = unittest.mock.MagicMock(side_effect=["Failed"])
+        self.client.poll_export = unittest.mock.MagicMock(side_effect=[{"status": "Failed"}])
 
         with self.assertRaises(ExportFailed):
             self.client.wait_for_export("test", export_id)
@@ -1,3 +1,7 @@
+import io
+import itertools
+import math
+import threading
 import unittest
 import unittest.mock
 import urllib.parse
@@ -5,6 +9,7 @@ import urllib.parse
 import freezegun
 import pendulum
 import requests_mock
+import urllib3
 
 from tap_marketo.client import Client, ApiException
 from tap_marketo.discover import (discover_catalog,
@@ -473,3 +478,460 @@ class MockResponse:
 #                                 "activityTypeId": 1, "primary_attribute_value_id": None, "primary_attribute_name": "webpage_id", "primary_attribute_value": '1', "client_ip_address": "0.0.0.0"}),
 #         ]
 #         write_record.assert_has_calls(expected_calls)
+
+
+class TestExportDownload(unittest.TestCase):
+    def setUp(self):
+        self.client = unittest.mock.MagicMock()
+
+    @unittest.mock.patch("tap_marketo.sync.DEFAULT_CHUNK_SIZE", 4)
+    @unittest.mock.patch("tap_marketo.sync.get_export_size", return_value=10)
+    def test_gen_range_chunks_in_order(self, get_export_size):
+        data = b"0123456789"
+        def fake_download(client, stream_type, export_id, start_byte, chunk_size):
+            return data[start_byte:start_byte + chunk_size]
+
+        with unittest.mock.patch("tap_marketo.sync.download_chunk", side_effect=fake_download):
+            chunks = list(gen_range_chunks(self.client, "leads", "123"))
+
+        self.assertEqual([b"0123", b"4567", b"89"], chunks)
+
+    def test_download_chunk_rejects_full_file(self):
+        # The server ignored the Range header and sent the whole file.
+        self.client.request.return_value.status_code = 200
+        self.client.request.return_value.content = b"0123456789"
+
+        self.assertEqual(b"0123456789", download_chunk(self.client, "leads", "123", 0, 10))
+        with self.assertRaises(ApiException):
+            download_chunk(self.client, "leads", "123", 0, 4)
+        with self.assertRaises(ApiException):
+            download_chunk(self.client, "leads", "123", 4, 4)
+
+    @unittest.mock.patch("time.sleep")
+    def test_download_chunk_retries_dropped_body(self, sleep):
+        client = Client("123-ABC-456", "id", "secret")
+        client.token_expires = pendulum.utcnow().add(days=1)
+        client.calls_today = 1
+        client._http2 = None
+
+        class DroppedBody(io.BytesIO):
+            def read(self, *args, **kwargs):
+                raise urllib3.exceptions.ProtocolError("Connection broken")
+
+        url = client.get_url(client.get_bulk_endpoint("leads", "file", "123"))
+        with requests_mock.Mocker() as mock:
+            mock.register_uri("GET", url, [{"body": DroppedBody(), "status_code": 206},
+                                           {"content": b"0123", "status_code": 206}])
+            self.assertEqual(b"0123", download_chunk(client, "leads", "123", 0, 4))
+            self.assertEqual(2, mock.call_count)
+
+    @unittest.mock.patch("tap_marketo.sync.DEFAULT_CHUNK_SIZE", 4)
+    @unittest.mock.patch("tap_marketo.sync.get_export_size")
+    def test_gen_range_chunks_uses_known_size(self, get_export_size):
+        with unittest.mock.patch("tap_marketo.sync.download_chunk", return_value=b"0123"):
+            chunks = list(gen_range_chunks(self.client, "leads", "123", export_size=8))
+
+        self.assertEqual([b"0123", b"0123"], chunks)
+        get_export_size.assert_not_called()
+
+    def test_gen_export_chunks_streams_by_default(self):
+        client = Client("123-ABC-456", "id", "secret")
+        client.stream_export = unittest.mock.MagicMock(return_value=iter([b"id\n"]))
+
+        self.assertEqual([b"id\n"], list(gen_export_chunks(client, "leads", "123")))
+        client.stream_export.assert_called_once_with("leads", "123")
+
+    def assert_read_export(self, chunks, expected_headers, expected_rows):
+        with unittest.mock.patch("tap_marketo.sync.gen_export_chunks", return_value=iter(chunks)):
+            headers, rows = read_export(self.client, "leads", "123")
+            rows = [list(row) for row in rows]
+
+        self.assertEqual(expected_headers, headers)
+        self.assertEqual(expected_rows, rows)
+
+    def check_read_export(self):
+        data = 'id,name\n1,"Zoë\nSmith"\n2,Ünal\n3,\n4,null\r\n5,a\u2028b'.encode("utf-8")
+        # Split inside the two-byte "ë" and inside the quoted newline row
+        self.assert_read_export([data[:14], data[14:20], data[20:]],
+                                ["id", "name"],
+                                [["1", "Zoë\nSmith"], ["2", "Ünal"], ["3", ""], ["4", "null"], ["5", "a\u2028b"]])
+        self.assert_read_export([b"id,name\n"], ["id", "name"], [])
+        self.assert_read_export([b"id,name\n1,a", b"b\n2,\n3,c\n"], ["id", "name"], [["1", "ab"], ["2", ""], ["3", "c"]])
+        self.assert_read_export([], [], [])
+        # Blank lines are skipped, with or without quoted values around
+        self.assert_read_export([b"id,name\n1,a\n\n2,b\n"], ["id", "name"], [["1", "a"], ["2", "b"]])
+        self.assert_read_export([b'id,name\n1,"a"\n\n2,b\n'], ["id", "name"], [["1", "a"], ["2", "b"]])
+        # A quote inside an unquoted value is just a character
+        self.assert_read_export([b'id,name\n1,5\'10" tall\n', b'2,"a\nb"\n3,c\n'], ["id", "name"],
+                                [["1", "5'10\" tall"], ["2", "a\nb"], ["3", "c"]])
+        # Ragged rows are returned as they are, in file order
+        self.assert_read_export([b'id,name\n1,a\n2\n3,"c\nd"\n4,d,x\n5,e\n'], ["id", "name"],
+                                [["1", "a"], ["2"], ["3", "c\nd"], ["4", "d", "x"], ["5", "e"]])
+        self.assert_read_export([b"id,name\n1\n"], ["id", "name"], [["1"]])
+
+    def test_gen_csv_rows_streams_after_stray_quote(self):
+        def chunks():
+            yield b'id,name\n1,5\'10" tall\n'
+            while True:
+                yield b"2,b\n"
+
+        rows = gen_csv_rows(chunks())
+        self.assertEqual([["id", "name"], ["1", "5'10\" tall"], ["2", "b"]], list(itertools.islice(rows, 3)))
+
+    def test_read_export(self):
+        self.check_read_export()
+
+    @unittest.mock.patch("tap_marketo.sync.pyarrow", None)
+    def test_read_export_without_pyarrow(self):
+        self.check_read_export()
+
+
+class TestCompileRowFn(unittest.TestCase):
+    def setUp(self):
+        self.stream = {
+            "tap_stream_id": "leads",
+            "metadata": [
+                {"breadcrumb": [], "metadata": {"selected": True}},
+                {"breadcrumb": ["properties", "id"], "metadata": {"inclusion": "automatic"}},
+                {"breadcrumb": ["properties", "email"], "metadata": {"inclusion": "available", "selected": True}},
+                {"breadcrumb": ["properties", "score"], "metadata": {"inclusion": "available", "selected": True}},
+                {"breadcrumb": ["properties", "phone"], "metadata": {"inclusion": "available"}},
+            ],
+            "schema": {"properties": {
+                "id": {"type": ["null", "integer"]},
+                "email": {"type": ["null", "string"]},
+                "score": {"type": ["null", "integer"]},
+                "phone": {"type": ["null", "string"]},
+            }},
+        }
+
+    def test_compile_row_fn(self):
+        row_fn = compile_row_fn(self.stream, ["email", "id", "phone"])
+        record = row_fn(["a@b.com", "12", "555"])
+
+        # score is selected but missing from the export, phone is not selected
+        self.assertEqual({"id": 12, "email": "a@b.com", "score": None}, record)
+
+    def test_compile_row_fn_short_row(self):
+        row_fn = compile_row_fn(self.stream, ["email", "id", "phone"])
+        self.assertEqual({"id": None, "email": "a@b.com", "score": None}, row_fn(["a@b.com"]))
+
+    def test_format_values(self):
+        row = {"id": "12.5", "email": "", "score": None, "phone": "555"}
+        self.assertEqual({"id": 12, "email": None, "score": None}, format_values(self.stream, row))
+
+    def test_format_string(self):
+        schema = {"type": ["null", "string"]}
+        value = "a@b.com"
+        self.assertIs(value, format_value(value, schema))
+        self.assertEqual("12", format_value(12, schema))
+        self.assertIsNone(format_value("null", schema))
+
+    def test_format_datetime_matches_pendulum(self):
+        schema = {"type": ["null", "string"], "format": "date-time"}
+        for value in ["2017-01-01T00:00:00Z", "2017-01-01", "2017-01-01 10:00:00",
+                      "2017-01-01T10:00:00.123Z", "2017-01-01T10:00:00-05:00"]:
+            self.assertEqual(pendulum.parse(value).isoformat(), format_value(value, schema))
+
+    @unittest.mock.patch("tap_marketo.sync._fromisoformat", None)
+    def test_format_datetime_without_fromisoformat(self):
+        schema = {"type": ["null", "string"], "format": "date-time"}
+        self.assertEqual("2017-01-01T00:00:00+00:00", format_value("2017-01-01T00:00:00Z", schema))
+
+
+class TestActivityRows(unittest.TestCase):
+    def setUp(self):
+        self.stream = {
+            "tap_stream_id": "activities_visit_webpage",
+            "metadata": [{"breadcrumb": [],
+                          "metadata": {"marketo.activity-id": 1,
+                                       "marketo.primary-attribute-name": "webpage_id"}}],
+        }
+
+    def test_flatten_attributes_beyond_orjson(self):
+        attributes = '{"Big Id": 123456789012345678901234567890, "Score": NaN, "Name": "\\ud800"}'
+        flattened = flatten_attributes(attributes)
+
+        self.assertEqual(123456789012345678901234567890, flattened["big_id"])
+        self.assertNotEqual(flattened["score"], flattened["score"])
+        self.assertEqual("\ud800", flattened["name"])
+
+    def test_compile_row_fn_activity(self):
+        self.stream["metadata"] += [
+            {"breadcrumb": ["properties", field], "metadata": {"inclusion": "automatic"}}
+            for field in ["marketoGUID", "leadId", "activityDate", "activityTypeId", "primary_attribute_name",
+                          "primary_attribute_value", "primary_attribute_value_id"]]
+        self.stream["metadata"] += [
+            {"breadcrumb": ["properties", "client_ip_address"], "metadata": {"selected": True}},
+            {"breadcrumb": ["properties", "query_parameters"], "metadata": {"selected": True}},
+        ]
+        self.stream["schema"] = {"properties": {
+            "marketoGUID": {"type": ["null", "string"]},
+            "leadId": {"type": ["null", "integer"]},
+            "activityDate": {"type": ["null", "string"], "format": "date-time"},
+            "activityTypeId": {"type": ["null", "integer"]},
+            "primary_attribute_name": {"type": ["null", "string"]},
+            "primary_attribute_value": {"type": ["null", "string"]},
+            "primary_attribute_value_id": {"type": ["null", "string"]},
+            "client_ip_address": {"type": ["null", "string"]},
+            "query_parameters": {"type": ["null", "string"]},
+        }}
+        row = ["abc123", "123", "2017-01-01T00:00:00Z", "1", "123", "",
+               json.dumps({"Client IP Address": "0.0.0.0", "Query Parameters": ""})]
+
+        expected = {
+            "marketoGUID": "abc123",
+            "leadId": 123,
+            "activityDate": "2017-01-01T00:00:00+00:00",
+            "activityTypeId": 1,
+            "client_ip_address": "0.0.0.0",
+            "query_parameters": None,
+            "primary_attribute_name": "webpage_id",
+            "primary_attribute_value": "123",
+            "primary_attribute_value_id": None,
+        }
+        row_fn = compile_row_fn(self.stream, ACTIVITY_FIELDS)
+        self.assertDictEqual(expected, row_fn(row))
+        # A row cut short before the attributes column
+        self.assertIsNone(row_fn(row[:2])["client_ip_address"])
+
+
+class TestBufferedSingerWriter(unittest.TestCase):
+    @unittest.mock.patch("sys.stdout", new_callable=io.StringIO)
+    def test_records_flushed_before_state(self, stdout):
+        writer = BufferedSingerWriter()
+        writer.write_record("leads", {"id": 1})
+        writer.write_record("leads", {"id": 2})
+        self.assertEqual("", stdout.getvalue())
+
+        writer.write_state({"bookmarks": {}})
+        messages = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual(["RECORD", "RECORD", "STATE"], [m["type"] for m in messages])
+        self.assertEqual({"id": 2}, messages[1]["record"])
+
+    @unittest.mock.patch("sys.stdout", new_callable=io.StringIO)
+    def test_flush_when_buffer_full(self, stdout):
+        writer = BufferedSingerWriter(buffer_size=1)
+        writer.write_record("leads", {"id": 1})
+        self.assertEqual(1, len(stdout.getvalue().splitlines()))
+
+    @unittest.mock.patch("sys.stdout", new_callable=io.StringIO)
+    def test_values_beyond_orjson(self, stdout):
+        attributes = '{"Big Id": 123456789012345678901234567890, "Score": NaN, "Name": "\\ud800"}'
+        writer = BufferedSingerWriter()
+        writer.write_record("activities_visit_webpage", flatten_attributes(attributes))
+        writer.flush()
+
+        record = json.loads(stdout.getvalue())["record"]
+        self.assertEqual(123456789012345678901234567890, record["big_id"])
+        self.assertTrue(math.isnan(record["score"]))
+        self.assertEqual("\ud800", record["name"])
+
+    def test_non_ascii_record_on_ascii_stdout(self):
+        stdout = io.TextIOWrapper(io.BytesIO(), encoding="ascii")
+        with unittest.mock.patch("sys.stdout", stdout):
+            writer = BufferedSingerWriter()
+            writer.write_record("leads", {"name": "Zo\u00eb"})
+            writer.write_state({"bookmarks": {}})
+
+        lines = stdout.buffer.getvalue().decode("utf-8").splitlines()
+        self.assertEqual("Zo\u00eb", json.loads(lines[0])["record"]["name"])
+        self.assertEqual("STATE", json.loads(lines[1])["type"])
+
+
+class TestSync(unittest.TestCase):
+    def setUp(self):
+        self.client = unittest.mock.MagicMock(use_corona=True)
+        self.catalog = {"streams": [
+            {"tap_stream_id": tap_stream_id,
+             "metadata": [{"breadcrumb": [], "metadata": {"selected": True}}]}
+            for tap_stream_id in ["campaigns", "lists"]]}
+
+    @staticmethod
+    def fake_sync_paginated(client, state, stream):
+        # Each stream should only see and write its own bookmarks
+        assert list(state["bookmarks"]) == [stream["tap_stream_id"]]
+        state = bookmarks.write_bookmark(state, stream["tap_stream_id"], "updatedAt", "2017-01-02T00:00:00Z")
+        WRITER.write_state(state)
+        return state, 0
+
+    @unittest.mock.patch("singer.write_state")
+    def test_sync_merges_stream_states(self, write_state):
+        state = {"currently_syncing": "lists",
+                 "bookmarks": {"campaigns": {"updatedAt": "2017-01-01T00:00:00Z"},
+                               "lists": {"updatedAt": "2017-01-01T00:00:00Z"}}}
+
+        with unittest.mock.patch("tap_marketo.sync.sync_paginated", side_effect=self.fake_sync_paginated) as sync_paginated:
+            sync(self.client, self.catalog, {}, state)
+
+        # Resuming from lists skips campaigns
+        self.assertEqual(1, sync_paginated.call_count)
+        self.assertEqual({"currently_syncing": None,
+                          "bookmarks": {"campaigns": {"updatedAt": "2017-01-01T00:00:00Z"},
+                                        "lists": {"updatedAt": "2017-01-02T00:00:00Z"}}},
+                         write_state.call_args[0][0])
+        self.assertIsNone(WRITER.state)
+
+    @unittest.mock.patch("singer.write_state")
+    def test_sync_with_no_parallel_streams(self, write_state):
+        state = {"bookmarks": {"campaigns": {"updatedAt": "2017-01-01T00:00:00Z"},
+                               "lists": {"updatedAt": "2017-01-01T00:00:00Z"}}}
+        with unittest.mock.patch("tap_marketo.sync.sync_paginated", side_effect=self.fake_sync_paginated) as sync_paginated:
+            sync(self.client, self.catalog, {"max_parallel_streams": 0}, state)
+
+        self.assertEqual(2, sync_paginated.call_count)
+        self.assertIsNone(write_state.call_args[0][0]["currently_syncing"])
+
+    @unittest.mock.patch("singer.write_state")
+    def test_sync_fails_without_waiting_for_other_streams(self, write_state):
+        state = {"bookmarks": {"campaigns": {"updatedAt": "2017-01-01T00:00:00Z"},
+                               "lists": {"updatedAt": "2017-01-01T00:00:00Z"}}}
+        started = threading.Event()
+        release = threading.Event()
+        finished = threading.Event()
+        errors = []
+
+        def fake_sync_paginated(client, state, stream):
+            if stream["tap_stream_id"] == "campaigns":
+                started.wait(5)
+                raise ApiException("Oh no!")
+            started.set()
+            release.wait(5)
+            try:
+                WRITER.write_record("lists", {"id": 1})
+            except RuntimeError as ex:
+                errors.append(ex)
+                raise
+            finally:
+                finished.set()
+            return state, 1
+
+        try:
+            with unittest.mock.patch("tap_marketo.sync.sync_paginated", side_effect=fake_sync_paginated):
+                with self.assertRaises(ApiException):
+                    sync(self.client, self.catalog, {"max_parallel_streams": 2}, state)
+            self.assertTrue(WRITER.closed)
+
+            # A later sync opens the writer again, the stream abandoned by
+            # the failed one still can't write
+            WRITER.open()
+        finally:
+            release.set()
+            finished.wait(5)
+            WRITER.state = None
+
+        self.assertEqual(1, len(errors))
+
+
+class TestPrefetchedRows(unittest.TestCase):
+    def test_gen_prefetched_rows(self):
+        rows = ([str(i)] for i in range(2500))
+        self.assertEqual([[str(i)] for i in range(2500)], list(gen_prefetched_rows(rows)))
+
+    def test_gen_prefetched_rows_error(self):
+        def rows():
+            yield ["1"]
+            raise ValueError("bad csv")
+
+        with self.assertRaises(ValueError):
+            list(gen_prefetched_rows(rows()))
+
+
+class TestSyncPages(unittest.TestCase):
+    def setUp(self):
+        self.client = Client("123-ABC-456", "id", "secret")
+        self.client.token_expires = pendulum.utcnow().add(days=1)
+        self.client.calls_today = 1
+        self.stream = {
+            "tap_stream_id": "campaigns",
+            "key_properties": ["id"],
+            "metadata": [
+                {"breadcrumb": [], "metadata": {"selected": True}},
+                {"breadcrumb": ["properties", "id"], "metadata": {"inclusion": "automatic"}},
+                {"breadcrumb": ["properties", "updatedAt"], "metadata": {"inclusion": "automatic"}},
+            ],
+            "schema": {"properties": {
+                "id": {"type": "integer"},
+                "updatedAt": {"type": "string", "format": "date-time"},
+            }},
+        }
+
+    @unittest.mock.patch("tap_marketo.sync.WRITER")
+    def test_sync_paginated(self, writer):
+        state = {"bookmarks": {"campaigns": {"updatedAt": "2017-01-01T00:00:00+00:00", "next_page_token": "abc"}}}
+        url = self.client.get_url("rest/v1/campaigns.json")
+        responses = [
+            {"json": {"success": True, "nextPageToken": "def",
+                      "result": [{"id": 1, "updatedAt": "2017-01-02T00:00:00Z"}]}, "status_code": 200},
+            {"json": {"success": True,
+                      "result": [{"id": 2, "updatedAt": "2016-01-02T00:00:00Z"}]}, "status_code": 200},
+        ]
+
+        with requests_mock.Mocker(real_http=True) as mock:
+            matcher = mock.register_uri("GET", url, responses)
+            state, record_count = sync_paginated(self.client, state, self.stream)
+
+        self.assertEqual(1, record_count)
+        self.assertDictEqual({"batchsize": "300", "nextpagetoken": "abc"}, parse_params(matcher.request_history[0]))
+        self.assertDictEqual({"batchsize": "300", "nextpagetoken": "def"}, parse_params(matcher.request_history[1]))
+        self.assertIsNone(state["bookmarks"]["campaigns"]["next_page_token"])
+
+    @unittest.mock.patch("tap_marketo.sync.WRITER")
+    def test_sync_paginated_fail(self, writer):
+        state = {"bookmarks": {"campaigns": {"updatedAt": "2017-01-01T00:00:00+00:00", "next_page_token": "abc"}}}
+        url = self.client.get_url("rest/v1/campaigns.json")
+
+        # The 200 with errors is an actual Marketo response to bad requests
+        responses = [
+            {"json": {"success": True, "result": [], "nextPageToken": "def"}, "status_code": 200},
+            {"json": {"success": False, "errors": [{"code": "601", "message": "bad"}]}, "status_code": 200},
+        ]
+
+        with requests_mock.Mocker(real_http=True) as mock:
+            mock.register_uri("GET", url, responses)
+            with self.assertRaises(ApiException):
+                sync_paginated(self.client, state, self.stream)
+
+        # The last paging token should still be there
+        self.assertEqual("def", state["bookmarks"]["campaigns"]["next_page_token"])
+
+
+class TestSyncLeads(unittest.TestCase):
+    def setUp(self):
+        self.client = Client("123-ABC-456", "id", "secret")
+        self.client._use_corona = False
+        self.client.export_available = unittest.mock.MagicMock(return_value=True)
+        self.client.wait_for_export = unittest.mock.MagicMock(return_value={"status": "Completed"})
+        self.stream = {
+            "tap_stream_id": "leads",
+            "key_properties": ["id"],
+            "metadata": [
+                {"breadcrumb": [], "metadata": {"selected": True}},
+                {"breadcrumb": ["properties", "id"], "metadata": {"inclusion": "automatic"}},
+                {"breadcrumb": ["properties", "updatedAt"], "metadata": {"inclusion": "automatic"}},
+            ],
+            "schema": {"properties": {
+                "id": {"type": "integer"},
+                "updatedAt": {"type": ["null", "string"], "format": "date-time"},
+            }},
+        }
+
+    @freezegun.freeze_time("2017-01-15")
+    @unittest.mock.patch("tap_marketo.sync.WRITER")
+    def test_sync_leads_no_corona(self, writer):
+        state = {"bookmarks": {"leads": {"updatedAt": "2017-01-01T00:00:00Z",
+                                         "export_id": "123",
+                                         "export_end": "2017-01-15T00:00:00+00:00"}}}
+        lines = (b"id,updatedAt\n"
+                 b"1,2016-12-31T00:00:00Z\n"
+                 b"2,2017-01-02T00:00:00Z\n"
+                 b"3,2017-01-01T19:00:00-05:00\n"
+                 b"4,null\n")
+        self.client.stream_export = unittest.mock.MagicMock(return_value=iter([lines]))
+
+        state, record_count = sync_leads(self.client, state, self.stream)
+
+        # The record from before the bookmark is filtered out
+        self.assertEqual(3, record_count)
+        self.assertEqual([2, 3, 4], [c[0][1]["id"] for c in writer.write_record.call_args_list])
+        self.assertEqual("2017-01-02T00:00:00+00:00", state["bookmarks"]["leads"]["updatedAt"])